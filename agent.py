@@ -1,70 +1,156 @@
 # agent.py (Final version with robust error handling and correct Matplotlib setup)
 
 import os
+import asyncio
 import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
 import traceback
-import io
-import sys
-import base64
 import json
+import orjson
 import re
+import subprocess
+import sys
+import threading
+import queue
+import concurrent.futures
+from protocol import HEADER, SCRIPT_FILENAME
 
-def execute_python_code(code: str) -> dict:
-    """Executes a complete string of Python code and returns its stdout and stderr."""
-    # Use a fresh state for each execution to ensure scripts are self-contained.
-    # We will pass required libraries into the execution context.
-    execution_globals = {
-        "pd": __import__("pandas"),
-        "np": __import__("numpy"),
-        "matplotlib": __import__("matplotlib"),
-        "plt": __import__("matplotlib.pyplot"),
-        "io": __import__("io"),
-        "base64": __import__("base64"),
-        "json": __import__("json"),
-    }
-    
-    old_stdout, old_stderr = sys.stdout, sys.stderr
-    sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
-    
-    try:
-        exec(code, execution_globals)
-    except Exception:
-        tb_string = traceback.format_exc()
-        sys.stderr.write(tb_string)
-    finally:
-        captured_stdout = sys.stdout.getvalue()
-        captured_stderr = sys.stderr.getvalue()
-        sys.stdout, sys.stderr = old_stdout, old_stderr
-        
-    return {"stdout": captured_stdout, "stderr": captured_stderr}
+# Extracts the body of the first fenced code block in the model's response.
+_CODE_FENCE_RE = re.compile(r"```(?:python\s*)?\n?([\s\S]+?)```", re.MULTILINE)
 
-class DataAnalystAgent:
-    def __init__(self, api_key: str, work_dir: str):
-        genai.configure(api_key=api_key)
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-        ]
-        self.model = genai.GenerativeModel(
-            model_name='gemini-1.5-flash-latest',
-            safety_settings=safety_settings
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+# Extra time a worker gets to enforce its own timeout before it is killed outright.
+KILL_GRACE_SECONDS = 5.0
+
+class _Worker:
+    """A long-lived worker.py subprocess with pandas/numpy/matplotlib already imported."""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
         )
-        self.work_dir = work_dir
-        self.request_options = {"timeout": 240.0}
 
-    def run(self, question: str, files: list) -> str:
-        original_dir = os.getcwd()
-        os.chdir(self.work_dir)
+    def run(self, code: str, cwd: str, files: dict, timeout: float) -> dict:
+        timed_out = threading.Event()
 
-        file_list_str = ", ".join(files) if files else "No files were uploaded."
-        
-        # --- DEFINITIVE PROMPT WITH MATPLOTLIB FIX ---
-        prompt = f"""You are an expert Python data analyst. Your task is to write a single, self-contained Python script to answer the user's request.
+        def kill():
+            timed_out.set()
+            self.process.kill()
+
+        timer = threading.Timer(timeout + KILL_GRACE_SECONDS, kill)
+        timer.start()
+        try:
+            payload = orjson.dumps({
+                "code": code,
+                "cwd": cwd,
+                "timeout": timeout,
+                "files": [[name, len(data)] for name, data in files.items()],
+            })
+            self.process.stdin.write(HEADER.pack(len(payload)) + payload)
+            # File contents follow the header as raw bytes, in the same order.
+            for data in files.values():
+                self.process.stdin.write(data)
+            self.process.stdin.flush()
+            header = self.process.stdout.read(HEADER.size)
+            if len(header) == HEADER.size:
+                (length,) = HEADER.unpack(header)
+                body = self.process.stdout.read(length)
+                if len(body) == length:
+                    return orjson.loads(body)
+        except OSError:
+            pass
+        finally:
+            timer.cancel()
+
+        if timed_out.is_set():
+            raise TimeoutError(f"Python script execution timed out after {timeout} seconds.")
+        raise RuntimeError("The Python execution worker exited unexpectedly.")
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class WorkerPool:
+    """A fixed-size pool of pre-warmed execution workers, one script per worker at a time."""
+
+    def __init__(self, size: int):
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(_Worker())
+        # One thread per worker: callers queue inside the executor rather than holding a thread
+        # while they wait for a free worker, so the event loop's default executor stays free.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix="worker-pool")
+
+    def submit(self, code: str, cwd: str, files: dict, timeout: float) -> dict:
+        worker = self._idle.get()
+        try:
+            return worker.run(code, cwd, files, timeout)
+        except (TimeoutError, RuntimeError):
+            # The worker was killed or crashed; replace it with a fresh one.
+            worker.kill()
+            worker = _Worker()
+            raise
+        finally:
+            self._idle.put(worker)
+
+    async def submit_async(self, code: str, cwd: str, files: dict, timeout: float) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.submit, code, cwd, files, timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+_pool = None
+_pool_lock = threading.Lock()
 
-User's files available in the current directory: [{file_list_str}]
+def start_worker_pool(size: int = None) -> WorkerPool:
+    """Starts the shared worker pool (sized to the CPU count by default) if it isn't running."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(size or os.cpu_count() or 1)
+        return _pool
+
+def execute_python_code(code: str, cwd: str, files: dict, timeout: float) -> dict:
+    """Executes a complete string of Python code in a pooled worker and returns its stdout and stderr.
+
+    `files` maps uploaded filenames to their raw bytes; the script sees it as `UPLOADED_FILES`.
+    """
+    return start_worker_pool().submit(code, cwd, files, timeout)
+
+async def execute_python_code_async(code: str, cwd: str, files: dict, timeout: float) -> dict:
+    """Awaitable execute_python_code for use from the event loop."""
+    return await start_worker_pool().submit_async(code, cwd, files, timeout)
+
+def create_model(api_key: str) -> genai.GenerativeModel:
+    """Configures the Gemini SDK and builds the model. Call once and share it across requests."""
+    genai.configure(api_key=api_key)
+    safety_settings = [
+        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+    ]
+    return genai.GenerativeModel(
+        model_name='gemini-1.5-flash-latest',
+        safety_settings=safety_settings
+    )
+
+# --- DEFINITIVE PROMPT ---
+# Static apart from the file list and question, which are filled in per request with str.format.
+_PROMPT_TEMPLATE = """You are an expert Python data analyst. Your task is to write a single, self-contained Python script to answer the user's request.
+
+User's uploaded files: [{file_list}]
+They are preloaded in memory as the `UPLOADED_FILES` dict, mapping each filename to its raw bytes, e.g. `pd.read_csv(io.BytesIO(UPLOADED_FILES['data.csv']))`. If a library needs a real file path, write the bytes to that filename in the current directory (also given as the `WORK_DIR` variable) first.
 User's request:
 ---
 {question}
@@ -72,40 +158,74 @@ User's request:
 
 CRITICAL INSTRUCTIONS:
 1.  Your output MUST be a single Python script wrapped in ```python ... ```.
-2.  **MATPLOTLIB SETUP:** If you need to generate a plot, the first three lines of your script MUST be exactly:
-    ```python
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    ```
-    This prevents server errors.
-3.  **PLOT GENERATION:** The script must generate plots, save them to an in-memory buffer (`io.BytesIO`), encode them to a base64 string, and format as a data URI (`data:image/png;base64,...`).
-4.  **FINAL OUTPUT:** The **very last line of your script** MUST be a single `print()` statement that outputs a valid JSON array or object containing all the answers. Convert numpy types (like np.int64) to standard Python types (int, float) before creating the JSON.
+2.  **PLOT GENERATION:** Use the pre-imported `plt`, `io`, `base64`, `json` (matplotlib is already set up for headless use). The script must generate plots, save them to an in-memory buffer (`io.BytesIO`), encode them to a base64 string, and format as a data URI (`data:image/png;base64,...`).
+3.  **FINAL OUTPUT:** The **very last line of your script** MUST be a single `print()` statement that outputs a valid JSON array or object containing all the answers. Convert numpy types (like np.int64) to standard Python types (int, float) before creating the JSON.
+4.  **NUMERIC LOOPS:** For numeric loops over large arrays, call these pre-loaded Numba-compiled helpers instead of writing Python loops: `pairwise_l2(a, b)` (Euclidean distances between the rows of 2-D float arrays), `rowwise_sum(a)` (sum of each row of a 2-D array), and `groupby_mean_numba(codes, values, n_groups)` (per-group mean, with `codes, uniques = pd.factorize(keys)` and `n_groups = len(uniques)`). Pass them NumPy arrays (e.g. `df[cols].to_numpy(dtype=float)`), not DataFrames.
 
 Example of a final line for a script requesting a number, a string, and a plot:
 `print(json.dumps([int(some_numpy_number), "some_string", plot_data_uri]))`
 """
+
+# How many times to re-prompt when the generated script doesn't compile.
+SYNTAX_RETRIES = 1
+_SYNTAX_RETRY_NOTE = """
+Your previous script, shown below, failed to compile with: {error}
+```python
+{script}
+```
+Return the complete corrected script.
+"""
+
+class DataAnalystAgent:
+    def __init__(self, model: genai.GenerativeModel, work_dir: str):
+        self.model = model
+        self.work_dir = os.path.abspath(work_dir)
+        self.request_options = {"timeout": 240.0}
+
+    async def _generate_script(self, prompt: str) -> str:
+        """Streams the model's response and returns its script as soon as the code fence closes."""
+        response = await self.model.generate_content_async(
+            prompt,
+            stream=True,
+            request_options=self.request_options
+        )
+        
+        text = ""
+        async for chunk in response:
+            if not chunk.candidates:
+                raise ValueError(f"API call failed: The request was likely blocked. Feedback: {chunk.prompt_feedback}")
+            # Chunks carrying only a finish reason (or a mid-stream SAFETY stop) have no parts.
+            if chunk.parts:
+                text += chunk.text
+            match = _CODE_FENCE_RE.search(text)
+            if match:
+                # Anything after the closing fence is commentary, so stop reading the stream.
+                return match.group(1).strip()
+        return text.strip()
+
+    async def run(self, question: str, files: dict):
+        file_list_str = ", ".join(files) if files else "No files were uploaded."
+        
+        prompt = _PROMPT_TEMPLATE.format(file_list=file_list_str, question=question)
         
         try:
             print("Calling Gemini API to generate Python script...")
-            response = self.model.generate_content(
-                prompt,
-                request_options=self.request_options
-            )
-            
-            if not response.candidates:
-                raise ValueError(f"API call failed: The request was likely blocked. Feedback: {response.prompt_feedback}")
-            
-            code_to_execute = response.text
-            match = re.search(r"```(python\s*)?([\s\S]+)```", code_to_execute, re.MULTILINE)
-            if match:
-                code_to_execute = match.group(2).strip()
-            else:
-                code_to_execute = code_to_execute.strip()
+            code_to_execute = await self._generate_script(prompt)
+            for _ in range(SYNTAX_RETRIES):
+                try:
+                    compile(code_to_execute, SCRIPT_FILENAME, "exec")
+                    break
+                except SyntaxError as e:
+                    print(f"Generated script does not compile ({e}); asking the model again...")
+                    code_to_execute = await self._generate_script(
+                        prompt + _SYNTAX_RETRY_NOTE.format(error=e, script=code_to_execute)
+                    )
             
             print(f"--- Agent Generated This Script ---\n{code_to_execute}\n-----------------------------------")
             
-            result = execute_python_code(code_to_execute)
+            result = await execute_python_code_async(
+                code_to_execute, self.work_dir, files, self.request_options["timeout"]
+            )
 
             # --- DEFINITIVE FIX FOR ERROR HANDLING ---
             # Only raise an exception if stderr contains a 'Traceback', ignoring warnings.
@@ -120,9 +240,13 @@ Example of a final line for a script requesting a number, a string, and a plot:
                     raise ValueError(f"The generated script did not print any output. Warnings: {result['stderr']}")
                 raise ValueError("The generated script did not print any output.")
 
-            json.loads(final_json_output)
+            try:
+                parsed = orjson.loads(final_json_output)
+            except orjson.JSONDecodeError:
+                # orjson rejects the NaN/Infinity tokens that json.dumps emits by default.
+                parsed = json.loads(final_json_output)
             print(f"SUCCESS: Script produced valid JSON output.")
-            return final_json_output
+            return parsed
 
         except (google_exceptions.RetryError, google_exceptions.DeadlineExceeded) as e:
             print(f"API Timeout/RetryError: The service is likely overloaded. {e}")
@@ -130,6 +254,4 @@ Example of a final line for a script requesting a number, a string, and a plot:
         except Exception as e:
             print(f"An unexpected error occurred in agent.run: {e}")
             traceback.print_exc()
-            raise
-        finally:
-            os.chdir(original_dir)
\ No newline at end of file
+            raise
\ No newline at end of file
@@ -1,58 +1,145 @@
 import os
+import asyncio
+import atexit
+import hashlib
 import uuid
 import shutil
-import json
-from flask import Flask, request, jsonify, render_template
-from agent import DataAnalystAgent
+import tempfile
+import concurrent.futures
+import orjson
+import cachetools
+from quart import Quart, Response, request, jsonify
+from agent import DataAnalystAgent, create_model, start_worker_pool
 import traceback
 from dotenv import load_dotenv
 from google.api_core import exceptions as google_exceptions
 
 load_dotenv()
-app = Flask(__name__)
+app = Quart(__name__)
+# Quart caps request bodies at 16 MiB and 60 s by default; Flask had no cap, and uploads of
+# large CSV/Parquet files are expected, so lift the size cap and give slow uploads time.
+app.config["MAX_CONTENT_LENGTH"] = None
+app.config["BODY_TIMEOUT"] = 600
 
 GOOGLE_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-if not os.path.exists("temp"):
-    os.makedirs("temp")
+# One configured Gemini model shared by all requests.
+model = create_model(GOOGLE_API_KEY) if GOOGLE_API_KEY else None
+
+# Per-request work directories go on RAM-backed tmpfs where available (Linux).
+TMP_ROOT = "/dev/shm/datamate" if os.path.isdir("/dev/shm") else "temp"
+os.makedirs(TMP_ROOT, exist_ok=True)
+
+# Pre-warm the script execution workers so the first request doesn't pay the import cost.
+worker_pool = start_worker_pool()
+atexit.register(worker_pool.shutdown)
+
+# Temp directories are removed off the request path so responses aren't held up by rmtree.
+_CLEANUP_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+@app.before_serving
+async def warm_up_model():
+    # The SDK caches one async gRPC client per process; open its channel (TLS + HTTP/2 setup)
+    # inside the serving event loop so the first real request doesn't pay for it.
+    if model is None:
+        return
+    try:
+        # One short attempt: an unreachable API must not hold up startup behind the SDK's retries.
+        await model.count_tokens_async("ping", request_options={"timeout": 5, "retry": None})
+        print("Gemini connection warmed up.")
+    except Exception as e:
+        print(f"WARNING: Could not warm up the Gemini connection: {e}")
 
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    # The page has no template logic, so serve it as a plain static file.
+    return await app.send_static_file('index.html')
+
+# Identical requests (same question and files) share one analysis while it runs,
+# and its result is reused for a short while afterwards.
+_RESULT_CACHE = cachetools.TTLCache(maxsize=128, ttl=60)
+_IN_FLIGHT = {}
+
+def _request_key(question_bytes: bytes, uploaded_files: dict) -> str:
+    # Each field is length-prefixed, so two different requests can't feed the hash the same bytes.
+    key = hashlib.blake2b()
+
+    def feed(field: bytes):
+        key.update(len(field).to_bytes(8, 'big'))
+        key.update(field)
+
+    feed(question_bytes)
+    for name in sorted(uploaded_files):
+        feed(name.encode('utf-8'))
+        feed(uploaded_files[name])
+    return key.hexdigest()
+
+async def _run_analysis(request_id: str, question: str, uploaded_files: dict):
+    temp_dir = tempfile.mkdtemp(prefix=f"{request_id}-", dir=TMP_ROOT)
+    print(f"Created temporary directory: {temp_dir}")
+    try:
+        agent = DataAnalystAgent(model=model, work_dir=temp_dir)
+        return await agent.run(question=question, files=uploaded_files)
+    finally:
+        if os.path.exists(temp_dir):
+            _CLEANUP_EXECUTOR.submit(shutil.rmtree, temp_dir, ignore_errors=True)
+            print(f"Scheduled cleanup of temporary directory: {temp_dir}")
+
+async def _coalesced_analysis(key: str, request_id: str, question: str, uploaded_files: dict):
+    if key in _RESULT_CACHE:
+        print(f"Request {request_id} matches a recent analysis; reusing its result.")
+        return _RESULT_CACHE[key]
+
+    task = _IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_run_analysis(request_id, question, uploaded_files))
+        _IN_FLIGHT[key] = task
+
+        def finished(task):
+            _IN_FLIGHT.pop(key, None)
+            # Only successful results are cached; failures are retried by the next request.
+            if not task.cancelled() and task.exception() is None:
+                _RESULT_CACHE[key] = task.result()
+
+        task.add_done_callback(finished)
+    else:
+        print(f"Request {request_id} matches an analysis in progress; waiting for it.")
+
+    # Shield the shared task so one client disconnecting doesn't cancel it for the others.
+    return await asyncio.shield(task)
 
 @app.route('/api/', methods=['POST'])
-def handle_analysis_request():
+async def handle_analysis_request():
     print("Received a new request to /api/")
     if not GOOGLE_API_KEY:
         print("ERROR: GOOGLE_API_KEY is not set.")
         return jsonify({"error": "API key is not configured on the server."}), 500
-    if 'questions.txt' not in request.files:
+    files = await request.files
+    if 'questions.txt' not in files:
         return jsonify({"error": "'questions.txt' is a required file part."}), 400
 
     request_id = str(uuid.uuid4())
-    temp_dir = os.path.join("temp", request_id)
-    os.makedirs(temp_dir)
-    print(f"Created temporary directory: {temp_dir}")
     
     try:
-        uploaded_files = []
-        for filename, file_storage in request.files.items():
-            sanitized_filename = os.path.basename(filename)
-            file_path = os.path.join(temp_dir, sanitized_filename)
-            file_storage.save(file_path)
-            if sanitized_filename != "questions.txt":
-                uploaded_files.append(sanitized_filename)
-        
-        question_path = os.path.join(temp_dir, "questions.txt")
-        with open(question_path, 'r', encoding='utf-8') as f:
-            question_content = f.read()
+        # Uploads are handed to the script in memory rather than saved and re-read from disk.
+        uploaded_files = {}
+        for filename, file_storage in files.items():
+            # Strip any client-supplied directories, POSIX or Windows style.
+            sanitized_filename = filename.rpartition('/')[2].rpartition('\\')[2]
+            # Large uploads are spooled to a temp file, so read them off the event loop.
+            data = await asyncio.to_thread(file_storage.stream.read)
+            if sanitized_filename == "questions.txt":
+                question_bytes = data
+            else:
+                uploaded_files[sanitized_filename] = data
+        question_content = question_bytes.decode('utf-8')
             
-        agent = DataAnalystAgent(api_key=GOOGLE_API_KEY, work_dir=temp_dir)
-        result_json_str = agent.run(question=question_content, files=uploaded_files)
-        response_data = json.loads(result_json_str)
+        # Hashing a large upload takes a while, so do it off the event loop too.
+        key = await asyncio.to_thread(_request_key, question_bytes, uploaded_files)
+        response_data = await _coalesced_analysis(key, request_id, question_content, uploaded_files)
         
         print("Successfully processed request. Sending JSON response.")
-        return jsonify(response_data)
+        return Response(orjson.dumps(response_data), mimetype="application/json")
 
     except (google_exceptions.RetryError, google_exceptions.DeadlineExceeded) as e:
         print(f"API Timeout/RetryError for request {request_id}: {e}")
@@ -65,11 +152,6 @@ def handle_analysis_request():
         print(f"An unexpected internal error occurred for request {request_id}: {e}")
         traceback.print_exc()
         return jsonify({"error": "An internal server error occurred.", "details": str(e)}), 500
-    
-    finally:
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            print(f"Cleaned up temporary directory: {temp_dir}")
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,9 @@
+# protocol.py (Constants shared by agent.py and the worker.py subprocesses)
+
+import struct
+
+# Frame header on the worker pipes: 4-byte big-endian payload length.
+HEADER = struct.Struct(">I")
+
+# Filename generated scripts are compiled under; used to pick their frames out of tracebacks.
+SCRIPT_FILENAME = "<agent-script>"
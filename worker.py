@@ -0,0 +1,213 @@
+# worker.py (Long-lived execution worker for agent-generated scripts)
+#
+# Started by the WorkerPool in agent.py. Reads length-prefixed JSON requests
+# ({"code": ..., "cwd": ..., "timeout": ..., "files": [[name, size], ...]}) on stdin, each
+# followed by the raw bytes of the listed files, and answers each with a
+# length-prefixed JSON result ({"stdout": ..., "stderr": ...}) on stdout.
+
+import os
+import io
+import contextlib
+import functools
+import base64
+import json
+import orjson
+import signal
+import traceback
+import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # Headless backend, set once before pyplot is imported.
+import matplotlib.pyplot as plt
+import numba
+from protocol import HEADER, SCRIPT_FILENAME
+
+# Cap on characters captured from each of a script's stdout and stderr.
+MAX_OUTPUT_CHARS = 32 * 1024 * 1024
+
+# Optional address-space cap for the worker, e.g. WORKER_MEMORY_LIMIT_MB=4096 (POSIX only).
+MEMORY_LIMIT_MB = os.environ.get("WORKER_MEMORY_LIMIT_MB")
+
+# Compiled numeric helpers offered to scripts in place of hand-written Python loops.
+# cache=True keeps the compiled machine code on disk, so only the first worker ever pays for it.
+# They stay single-threaded: the pool already runs one worker per CPU.
+@numba.njit(cache=True)
+def pairwise_l2(a, b):
+    """Euclidean distances between the rows of 2-D float arrays `a` (n, d) and `b` (m, d)."""
+    out = np.empty((a.shape[0], b.shape[0]))
+    for i in range(a.shape[0]):
+        for j in range(b.shape[0]):
+            total = 0.0
+            for k in range(a.shape[1]):
+                diff = a[i, k] - b[j, k]
+                total += diff * diff
+            out[i, j] = np.sqrt(total)
+    return out
+
+@numba.njit(cache=True)
+def rowwise_sum(a):
+    """Sum of each row of a 2-D numeric array."""
+    out = np.empty(a.shape[0])
+    for i in range(a.shape[0]):
+        total = 0.0
+        for j in range(a.shape[1]):
+            total += a[i, j]
+        out[i] = total
+    return out
+
+@numba.njit(cache=True)
+def groupby_mean_numba(codes, values, n_groups):
+    """Mean of `values` per group, where `codes` holds group ids 0..n_groups-1 (e.g. from pd.factorize).
+
+    Rows with a negative code (pd.factorize's marker for missing keys) are skipped, and
+    groups with no rows come out as NaN.
+    """
+    sums = np.zeros(n_groups)
+    counts = np.zeros(n_groups)
+    for i in range(codes.shape[0]):
+        code = codes[i]
+        if code < 0:
+            continue
+        sums[code] += values[i]
+        counts[code] += 1
+    out = np.full(n_groups, np.nan)
+    for g in range(n_groups):
+        if counts[g] > 0:
+            out[g] = sums[g] / counts[g]
+    return out
+
+# Libraries passed into every execution context. Built once at worker start;
+# each execution gets its own shallow copy so scripts stay self-contained.
+_BASE_GLOBALS = {
+    "pd": pd,
+    "np": np,
+    "matplotlib": matplotlib,
+    "plt": plt,
+    "io": io,
+    "base64": base64,
+    "json": json,
+    "numba": numba,
+    "pairwise_l2": pairwise_l2,
+    "rowwise_sum": rowwise_sum,
+    "groupby_mean_numba": groupby_mean_numba,
+    "__builtins__": __builtins__,
+}
+
+class BoundedStringIO(io.StringIO):
+    """A StringIO that raises instead of growing past `limit` characters."""
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, s: str) -> int:
+        if self.tell() + len(s) > self.limit:
+            raise RuntimeError(f"output too large (more than {self.limit} characters)")
+        return super().write(s)
+
+def format_script_error(exc: BaseException) -> str:
+    """Formats an error from a generated script without rendering every library frame.
+
+    Only the innermost frame that belongs to the script itself is reported, followed by
+    the exception line; that is what the model's author needs, and it skips the cost of
+    formatting deep pandas/numpy stacks.
+    """
+    lines = ["Traceback (most recent call last):\n"]
+    script_frame = None
+    for frame, lineno in traceback.walk_tb(exc.__traceback__):
+        if frame.f_code.co_filename == SCRIPT_FILENAME:
+            script_frame = (lineno, frame.f_code.co_name)
+    if script_frame is not None:
+        lines.append(f'  File "{SCRIPT_FILENAME}", line {script_frame[0]}, in {script_frame[1]}\n')
+    lines.extend(traceback.format_exception_only(type(exc), exc))
+    return "".join(lines)
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("Python script execution exceeded its time limit.")
+
+@functools.lru_cache(maxsize=256)
+def _compile(source: str):
+    """Compiles a script once; the model often regenerates identical scripts for repeated questions."""
+    return compile(source, SCRIPT_FILENAME, "exec")
+
+def read_message(stream) -> dict:
+    """Reads one length-prefixed JSON message, or returns None on EOF."""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (length,) = HEADER.unpack(header)
+    return orjson.loads(stream.read(length))
+
+def write_message(stream, message: dict) -> None:
+    """Writes one length-prefixed JSON message and flushes it."""
+    payload = orjson.dumps(message)
+    stream.write(HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+def execute_python_code(code: str, cwd: str, files: dict, timeout: float) -> dict:
+    """Executes a complete string of Python code in `cwd` and returns its stdout and stderr."""
+    try:
+        compiled = _compile(code)
+    except SyntaxError as e:
+        return {"stdout": "", "stderr": format_script_error(e)}
+
+    # Each worker runs one script at a time, so changing its own CWD is safe here;
+    # the server process never changes directory.
+    os.chdir(cwd)
+    # Use a fresh state for each execution to ensure scripts are self-contained.
+    execution_globals = _BASE_GLOBALS.copy()
+    execution_globals["WORK_DIR"] = cwd
+    execution_globals["UPLOADED_FILES"] = files
+
+    # The traceback is kept apart from the captured stream so it survives a full stderr.
+    tb_string = ""
+    out, err = BoundedStringIO(MAX_OUTPUT_CHARS), BoundedStringIO(MAX_OUTPUT_CHARS)
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            # Interrupt runaway scripts ourselves; agent.py kills the whole worker only as a backstop.
+            # The timer is armed and disarmed inside the outer try, so a SIGALRM that lands just
+            # before exec starts or just after it ends is still reported as the script's timeout.
+            try:
+                if hasattr(signal, "setitimer"):
+                    signal.setitimer(signal.ITIMER_REAL, timeout)
+                exec(compiled, execution_globals)
+            finally:
+                if hasattr(signal, "setitimer"):
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except SystemExit:
+            # A script calling sys.exit() simply ends early; the worker keeps serving.
+            pass
+        except Exception as e:
+            tb_string = format_script_error(e)
+        finally:
+            # Drop any figures the script left open so they don't accumulate across requests.
+            plt.close("all")
+
+    return {"stdout": out.getvalue(), "stderr": err.getvalue() + tb_string}
+
+def main() -> None:
+    if hasattr(signal, "setitimer"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+    if MEMORY_LIMIT_MB:
+        import resource
+        limit = int(MEMORY_LIMIT_MB) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    # Keep private handles on the protocol pipes, then point fds 0/1 elsewhere so
+    # a script reading stdin or writing straight to fd 1 can't corrupt the framing.
+    protocol_in = os.fdopen(os.dup(0), "rb")
+    protocol_out = os.fdopen(os.dup(1), "wb")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+
+    while True:
+        message = read_message(protocol_in)
+        if message is None:
+            break
+        files = {name: protocol_in.read(size) for name, size in message["files"]}
+        write_message(protocol_out, execute_python_code(message["code"], message["cwd"], files, message["timeout"]))
+
+if __name__ == "__main__":
+    main()